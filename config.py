@@ -1,6 +1,9 @@
 # ONNX_MODEL_PATH = "../resnet50_resa_tusimple_20211019.onnx"
 ONNX_MODEL_PATH = "../resnet50_resa_culane_20211016.onnx"
 BENCHMARK = False
+ONNX_FP16 = True  # run the ONNX model in half precision on CUDA, needs the onnx and onnxconverter-common packages
+ONNX_TENSORRT = True  # use the TensorRT execution provider if onnxruntime supports it
+TENSORRT_CACHE_PATH = "./trt_cache"
 
 # input_sizes = (360, 640)    # tusimple
 input_sizes = (288, 800)  # culane
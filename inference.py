@@ -1,9 +1,11 @@
+import os
+from functools import lru_cache
 from config import *
+import cv2
 import onnxruntime as ort
 import numpy as np
 import torch
 from config import *
-import pytorch_auto_drive.functional as F
 from lanefitting import get_offset_center
 
 from pytorch_auto_drive.utils import (
@@ -11,18 +13,161 @@ from pytorch_auto_drive.utils import (
     lane_detection_visualize_batched,
 )
 
+try:
+    import onnx
+except ImportError:
+    onnx = None
+try:
+    from onnxconverter_common import float16
+except ImportError:
+    float16 = None
+
+
+def preprocess(image, out=None):
+    """Converts an RGB (H, W, C) image to the NCHW float32 model input in [0, 1]
+
+    uint8 images (PIL or array) are scaled by 1/255, float images are expected to be in [0, 1] already.
+    If given, the result is written to the preallocated (1, 3, H, W) float32 buffer out.
+    """
+    image = np.asarray(image)
+    scale = np.float32(1 / 255) if image.dtype == np.uint8 else np.float32(1)
+    image = cv2.resize(image, (input_sizes[1], input_sizes[0]), interpolation=cv2.INTER_LINEAR)
+    if out is None:
+        out = np.empty((1, 3, input_sizes[0], input_sizes[1]), dtype=np.float32)
+    # transpose, cast and scale in a single pass
+    np.multiply(image.transpose(2, 0, 1), scale, out=out[0], casting="unsafe")
+    return out
+
+
+def convert_to_fp16(model_path):
+    """Returns the path of a FP16 copy of the model, converting it on first use
+
+    Inputs and outputs are kept in FP32, so callers can keep passing np.float32 arrays.
+    """
+    fp16_model_path = os.path.splitext(model_path)[0] + ".fp16.onnx"
+    if not os.path.exists(fp16_model_path):
+        if onnx is None or float16 is None:
+            print("onnx or onnxconverter_common is not installed, using the FP32 model")
+            return model_path
+        model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+        onnx.save(model, fp16_model_path)
+    return fp16_model_path
+
+
+def tensorrt_options():
+    # the policies run one frame per step, so the engine built for the first input shape is never rebuilt
+    # and a dynamic batch axis needs no explicit optimization profile
+    return {
+        "trt_fp16_enable": True,
+        # building the engines takes minutes, they are cached on disk and reused
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": TENSORRT_CACHE_PATH,
+        "trt_max_workspace_size": 2 * 1024**3,
+    }
+
 
 class ONNXPipeline:
     def __init__(self, model_path=ONNX_MODEL_PATH):
+        # TensorRT is listed whenever onnxruntime was built with it, even if its libraries cannot be loaded.
+        # ORT then silently drops it, so the session is rebuilt with FP16 and the optimized graph cache
+        use_tensorrt = ONNX_TENSORRT and 'TensorrtExecutionProvider' in ort.get_available_providers()
+        self.ort_sess = self.create_session(model_path, use_tensorrt)
+        if use_tensorrt and 'TensorrtExecutionProvider' not in self.ort_sess.get_providers():
+            print("TensorRT could not be loaded, using the CUDA execution provider")
+            self.ort_sess = self.create_session(model_path, False)
+
+        # reused for every host-side preprocessing call
+        self._prep_buf = np.empty((1, 3, input_sizes[0], input_sizes[1]), dtype=np.float32)
+
+        # outputs stay on the GPU when the input is bound from device memory (see run_on_device)
+        self.on_cuda = 'CUDAExecutionProvider' in self.ort_sess.get_providers()
+        self.io_binding = self.ort_sess.io_binding()
+        if self.on_cuda:
+            for output in self.ort_sess.get_outputs():
+                if all(isinstance(dim, int) for dim in output.shape):
+                    self.io_binding.bind_ortvalue_output(
+                        output.name,
+                        ort.OrtValue.ortvalue_from_shape_and_type(output.shape, np.float32, "cuda", 0),
+                    )
+                else:
+                    self.io_binding.bind_output(output.name, "cuda")
+
+        self.warmup()
+
+    def create_session(self, model_path, use_tensorrt):
         sess_opt = ort.SessionOptions()
         sess_opt.intra_op_num_threads = 8
 
-        self.ort_sess = ort.InferenceSession(
+        cuda_options = {
+            "cudnn_conv_algo_search": "EXHAUSTIVE",
+            "do_copy_in_default_stream": True,
+            "arena_extend_strategy": "kNextPowerOfTwo",
+        }
+        providers = [('CUDAExecutionProvider', cuda_options), 'CPUExecutionProvider']
+
+        # TensorRT gets the original FP32 graph: it does the FP16 conversion and layer fusion itself,
+        # and an ORT-optimized graph may contain fused nodes only the CUDA/CPU providers know
+        if use_tensorrt:
+            providers.insert(0, ('TensorrtExecutionProvider', tensorrt_options()))
+
+        # FP16 only pays off with tensor cores, the CPU provider would insert casts around most nodes
+        if not use_tensorrt and ONNX_FP16 and 'CUDAExecutionProvider' in ort.get_available_providers():
+            model_path = convert_to_fp16(model_path)
+
+        if use_tensorrt:
+            sess_opt.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        else:
+            # the graph optimizations are done once and the result is stored next to the model,
+            # later runs load the optimized graph and skip the optimization step.
+            # ORT_ENABLE_ALL output is specific to the providers, so they are part of the cache name together
+            # with the modification time of the source model, which invalidates the cache when the model changes
+            provider_tag = "cuda" if 'CUDAExecutionProvider' in ort.get_available_providers() else "cpu"
+            model_mtime = int(os.path.getmtime(model_path))
+            optimized_model_path = f"{os.path.splitext(model_path)[0]}.{provider_tag}.{model_mtime}.opt.onnx"
+            if os.path.exists(optimized_model_path):
+                model_path = optimized_model_path
+                sess_opt.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                sess_opt.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                sess_opt.optimized_model_filepath = optimized_model_path
+
+        return ort.InferenceSession(
             model_path,
-            providers=['CUDAExecutionProvider', 'CPUExecutionProvider'],
+            providers=providers,
             sess_options=sess_opt,
         )
 
+    def warmup(self, iterations=3):
+        # the first runs pay for cuDNN algorithm search and memory planning,
+        # session.run is synchronous so all kernels are set up once this returns
+        model_input = self.ort_sess.get_inputs()[0]
+        default_shape = (1, 3, input_sizes[0], input_sizes[1])
+        shape = [dim if isinstance(dim, int) else default for dim, default in zip(model_input.shape, default_shape)]
+        dummy = np.zeros(shape, dtype=np.float32)
+        for _ in range(iterations):
+            self.ort_sess.run(None, {model_input.name: dummy})
+
+    def run_on_device(self, image):
+        """Runs the model on a (H, W, C) float image in [0, 1] that lives on the GPU (e.g. a cupy array)"""
+        # image arrives in (H, W, C), needs to have [C, H, W] format
+        image = torch.as_tensor(image, device="cuda").permute(2, 0, 1).unsqueeze(0)
+        model_in = torch.nn.functional.interpolate(
+            image.float(), size=input_sizes, mode="bilinear", align_corners=False
+        ).contiguous()
+
+        self.io_binding.bind_input(
+            name="input1",
+            device_type="cuda",
+            device_id=model_in.device.index,
+            element_type=np.float32,
+            shape=tuple(model_in.shape),
+            buffer_ptr=model_in.data_ptr(),
+        )
+        # ORT runs on its own stream, the resize has to be finished before it reads the input
+        torch.cuda.current_stream().synchronize()
+        self.ort_sess.run_with_iobinding(self.io_binding)
+        return self.io_binding.copy_outputs_to_cpu()
+
     def inference(self, model_in, original_img, orig_sizes, keypoints_only=False):
         onnx_out = self.ort_sess.run(None, {"input1": model_in})
         outputs = {"out": torch.Tensor(onnx_out[0]), "lane": torch.Tensor(onnx_out[1])}
@@ -51,20 +196,13 @@ class ONNXPipeline:
         return results, keypoints
 
     def infer_offset_center(self, image, orig_sizes):
-        image = F.resize(image, size=input_sizes)
-        model_in = torch.ByteTensor(torch.ByteStorage.from_buffer(image.tobytes()))
-
-        model_in = model_in.view(image.size[1], image.size[0], len(image.getbands()))
-        model_in = (
-            model_in.permute((2, 0, 1))
-            .contiguous()
-            .float()
-            .div(255)
-            .unsqueeze(0)
-            .numpy()
-        )
-
-        onnx_out = self.ort_sess.run(None, {"input1": model_in})
+        if hasattr(image, "__cuda_array_interface__"):
+            if self.on_cuda:
+                onnx_out = self.run_on_device(image)
+            else:
+                onnx_out = self.ort_sess.run(None, {"input1": preprocess(image.get(), out=self._prep_buf)})
+        else:
+            onnx_out = self.ort_sess.run(None, {"input1": preprocess(image, out=self._prep_buf)})
         outputs = {"out": torch.Tensor(onnx_out[0]), "lane": torch.Tensor(onnx_out[1])}
 
         keypoints = lane_as_segmentation_inference(
@@ -84,3 +222,14 @@ class ONNXPipeline:
         )
 
         return off_center, lane_heading_theta, keypoints[0]
+
+
+@lru_cache(maxsize=4)
+def get_pipeline(model_path=ONNX_MODEL_PATH):
+    """Returns an ONNXPipeline shared between all callers using the same model
+
+    Creating the ORT session (model loading, graph optimization, CUDA init, warm-up) is expensive,
+    so code that runs inference in a loop (e.g. a policy created per scenario) should
+    use this instead of constructing a new ONNXPipeline.
+    """
+    return ONNXPipeline(model_path)
@@ -36,6 +36,20 @@ elif MODEL == "scnn":
     CONFIG=os.path.join(script_dir, 'attack/pytorch_auto_drive/configs/lane_detection/scnn/resnet50_culane.py').replace('\\','/')
     CHECKPOINT=os.path.join(script_dir, '../resnet50_scnn_culane_20210311.pt').replace('\\','/')
 
+def resize_to_input(image):
+    """Resizes a (C, H, W) tensor, PIL image or (H, W, C) numpy array to input_sizes"""
+    if isinstance(image, np.ndarray):
+        return cv2.resize(image, (input_sizes[1], input_sizes[0]), interpolation=cv2.INTER_LINEAR)
+    return F.resize(image, size=input_sizes)
+
+def to_model_input(image):
+    """Converts a PIL image or (H, W, C) uint8 array to the (1, C, H, W) float32 model input in [0, 1]"""
+    image = np.asarray(image)
+    model_in = np.empty((1, image.shape[2], image.shape[0], image.shape[1]), dtype=np.float32)
+    # transpose, cast and scale in a single pass
+    np.multiply(image.transpose(2, 0, 1), np.float32(1 / 255), out=model_in[0], casting="unsafe")
+    return model_in
+
 @dataclass
 class DirtyRoadPatch:
     model_in: np.ndarray
@@ -97,6 +111,8 @@ class PyTorchPipeline:
         )
 
         self.targeted = targeted
+        # set together with converting self.model, e.g. to torch.channels_last; None keeps the default layout
+        self.memory_format = None
         self.attack = MyRobustDPatch(estimator=classifier, 
                         max_iter=200,
                         sample_size=1,
@@ -143,27 +159,23 @@ class PyTorchPipeline:
 
 
         if orig_sizes != input_sizes:
-            image = F.resize(image, size=input_sizes) #, interpolation=Image.NEAREST)
+            image = resize_to_input(image) #, interpolation=Image.NEAREST)
 
 
         if image_on_cuda:
             model_in = image.unsqueeze(0)
+            if self.memory_format is not None:
+                model_in = model_in.contiguous(memory_format=self.memory_format)
             results = self.model(model_in)
             # self.save_image(model_in[0].cpu().numpy(), f'camera_observations/{control_object.engine.episode_step}_model_input.jpg')
         else:
-            model_in = torch.ByteTensor(torch.ByteStorage.from_buffer(image.tobytes()))
-            model_in = model_in.view(image.size[1], image.size[0], len(image.getbands()))
-            model_in = (
-                model_in.permute((2, 0, 1))
-                .contiguous()
-                .float()
-                .div(255)
-                .unsqueeze(0)
-                .numpy()
-            )
+            model_in = to_model_input(image)
 
             # self.save_image(model_in[0], f'camera_observations/{control_object.engine.episode_step}_model_input.jpg')
-            results = self.model(torch.from_numpy(model_in).to(self.device))
+            model_in = torch.from_numpy(model_in).to(self.device)
+            if self.memory_format is not None:
+                model_in = model_in.contiguous(memory_format=self.memory_format)
+            results = self.model(model_in)
 
         keypoints = lane_as_segmentation_inference(
             None,
@@ -205,28 +217,26 @@ class PyTorchPipeline:
             # image = torch.from_numpy(image).permute(2, 0, 1)
 
 
-        image = F.resize(image, size=input_sizes) #, interpolation=Image.NEAREST)
+        image = resize_to_input(image) #, interpolation=Image.NEAREST)
 
 
         if image_on_cuda:
             model_in = image.unsqueeze(0)
         else:
-            model_in = torch.ByteTensor(torch.ByteStorage.from_buffer(image.tobytes()))
-            model_in = model_in.view(image.size[1], image.size[0], len(image.getbands()))
-            model_in = (
-                model_in.permute((2, 0, 1))
-                .contiguous()
-                .float()
-                .div(255)
-                .unsqueeze(0)
-                .numpy()
-            ) 
+            model_in = to_model_input(image)
         
         if generate_patch or self.current_patch is None:
-            if self.targeted:
-                self.current_patch = self.attack.generate(x=model_in.cpu().numpy() if image_on_cuda else model_in.copy(), y=target)[0]
-            else:
-                self.current_patch = self.attack.generate(x=model_in.cpu().numpy() if image_on_cuda else model_in.copy())[0]
+            # the attack feeds NCHW batches to the model, a model in another layout would convert them on every iteration
+            if self.memory_format is not None:
+                self.model.to(memory_format=torch.contiguous_format)
+            try:
+                if self.targeted:
+                    self.current_patch = self.attack.generate(x=model_in.cpu().numpy() if image_on_cuda else model_in.copy(), y=target)[0]
+                else:
+                    self.current_patch = self.attack.generate(x=model_in.cpu().numpy() if image_on_cuda else model_in.copy())[0]
+            finally:
+                if self.memory_format is not None:
+                    self.model.to(memory_format=self.memory_format)
             # self.save_image(self.current_patch, f'camera_observations/{control_object.engine.episode_step}_patch.jpg', sizes=(self.current_patch.shape[1], self.current_patch.shape[2]))
         
         patch = self.current_patch
@@ -238,7 +248,10 @@ class PyTorchPipeline:
 
         # self.save_image(model_in[0].cpu().numpy(), f'camera_observations/{control_object.engine.episode_step}_model_input.jpg')
 
-        results = self.model(model_in) if image_on_cuda else self.model(torch.from_numpy(model_in).to(self.device))
+        model_in = model_in if image_on_cuda else torch.from_numpy(model_in).to(self.device)
+        if self.memory_format is not None:
+            model_in = model_in.contiguous(memory_format=self.memory_format)
+        results = self.model(model_in)
 
         keypoints = lane_as_segmentation_inference(
             None,
@@ -1,6 +1,13 @@
 import cv2
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the camera helpers below run as plain Python
+    def njit(*args, **kwargs):
+        return lambda function: function
+
 def get_offset_center(keypoints, image_size: tuple, transform_matrix=None) -> float:
     """Calculates the offset from the center of the lane in meters
 
@@ -174,16 +181,14 @@ def calculate_radius(left_lane_poly, right_lane_poly, image_size: tuple):
     return radius
 
 
-def draw_lane(image, keypoints, image_size: tuple, transform_matrix=None):
-    if len(keypoints) < 2:
-        print("No lanes detected")
-        image_np = np.array(image)
-        cv2.putText(image_np, f'NO LANES DETECTED', (10, 60), cv2.FONT_HERSHEY_SIMPLEX , 2, (0, 0, 255), 2, cv2.LINE_AA)
-        return image_np
-
-    if transform_matrix is None: 
-        transform_matrix, _ = get_transform_matrix(image_size)
+def draw_no_lanes(image):
+    print("No lanes detected")
+    image_np = np.array(image)
+    cv2.putText(image_np, f'NO LANES DETECTED', (10, 60), cv2.FONT_HERSHEY_SIMPLEX , 2, (0, 0, 255), 2, cv2.LINE_AA)
+    return image_np
 
+def fit_ego_lane(keypoints, image_size: tuple, transform_matrix):
+    """Fits the ego lane in BEV, shared by draw_lane and draw_lane_bev"""
     left_lane_bev, right_lane_bev, selected_indices = get_ego_lanes(keypoints, transform_matrix, image_size)
 
     if (selected_indices[0] == selected_indices[1]):
@@ -203,71 +208,61 @@ def draw_lane(image, keypoints, image_size: tuple, transform_matrix=None):
     l1 = np.transpose(np.vstack([left_fit, y_range]))
     l2 = np.flip(np.transpose(np.vstack([right_fit, y_range])), axis=0) 
     pts = np.int_(np.vstack((l1, l2)))
+    color_fill_image = cv2.fillPoly(color_fill_image, [pts], (0, 255, 0))  
 
-    image_np = np.array(image)
+    offset_center, theta, debug_info = get_offset_center(keypoints, image_size, transform_matrix=transform_matrix)
 
-    colors = [(255,0,0), (0,255,0), (0,0,255), (0,255,255), (255,255,0), (255,0,255)]
-    for i, lane in enumerate(keypoints):
-        w = 3 if i in selected_indices else 1        
-        for point in lane:
-            cv2.circle(image_np, (int(point[0]), int(point[1])), w, colors[i], -1)
+    # current lane center
+    # debug_info = {radius, angle_rad, start_point, end_point}
+    left_lane_start = left_lane_poly(height)
+    right_lane_start = right_lane_poly(height)
+    current_center_x = left_lane_start + (right_lane_start - left_lane_start) / 2
+
+    return selected_indices, color_fill_image, offset_center, current_center_x
+
+def draw_lane_overlay(image_np, image_size: tuple, offset_center, current_center_x, direction):
+    width = image_size[0]
+    height = image_size[1]
 
-    offset_center, theta, debug_info = get_offset_center(keypoints, image_size, transform_matrix=transform_matrix)
     cv2.putText(image_np, f'Offset center: {offset_center}px (+ means deviation to right,- means to the left)', (10, 20), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
     # cv2.putText(image_np, f'Theta: {theta} ({np.rad2deg(theta)})', (10, 40), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
-    direction = "right" if offset_center < 0 else "left" if offset_center > 0 else "straight"
     cv2.putText(image_np, f'Steering direction: {direction}. Green circle is desired center. White is current lane center.', (10, 40), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
 
     # desired center
     cv2.circle(image_np, (int(width/2), int(height-3)), 3, (0, 255, 0), -1, cv2.LINE_AA)
 
     # current lane center
-    # debug_info = {radius, angle_rad, start_point, end_point}
-    left_lane_start = left_lane_poly(height)
-    right_lane_start = right_lane_poly(height)
-    current_center_x = left_lane_start + (right_lane_start - left_lane_start) / 2
     cv2.circle(image_np, (int(current_center_x), int(height-3)), 3, (255, 255, 255), -1, cv2.LINE_AA)
     # end_point_transformed = perspective_warp(np.array([debug_info[3]]), transform_matrix_inv)[0]
     # cv2.arrowedLine(image_np, (int(width/2), int(height-3)), np.int_(end_point_transformed), (0, 0, 0), 1, cv2.LINE_AA)  
 
-    color_fill_image = cv2.fillPoly(color_fill_image, [pts], (0, 255, 0))  
-    color_fill_image_transformed = cv2.warpPerspective(color_fill_image, transform_matrix, (width, height), flags=cv2.WARP_INVERSE_MAP)
-    result = cv2.addWeighted(image_np, 1, color_fill_image_transformed, 0.2, 0, dtype=cv2.CV_8U)
-
-    return result
+def render_lane(image, keypoints, image_size: tuple, transform_matrix, ego_lane):
+    selected_indices, color_fill_image, offset_center, current_center_x = ego_lane
+    width = image_size[0]
+    height = image_size[1]
 
-def draw_lane_bev(image, keypoints, image_size: tuple, transform_matrix=None):
-    if len(keypoints) < 2:
-        print("No lanes detected")
-        image_np = np.array(image)
-        cv2.putText(image_np, f'NO LANES DETECTED', (10, 60), cv2.FONT_HERSHEY_SIMPLEX , 2, (0, 0, 255), 2, cv2.LINE_AA)
-        return image_np
+    image_np = np.array(image)
 
-    if transform_matrix is None: 
-        transform_matrix, _ = get_transform_matrix(image_size)
+    colors = [(255,0,0), (0,255,0), (0,0,255), (0,255,255), (255,255,0), (255,0,255)]
+    for i, lane in enumerate(keypoints):
+        w = 3 if i in selected_indices else 1        
+        for point in lane:
+            cv2.circle(image_np, (int(point[0]), int(point[1])), w, colors[i], -1)
 
-    left_lane_bev, right_lane_bev, selected_indices = get_ego_lanes(keypoints, transform_matrix, image_size)
+    direction = "right" if offset_center < 0 else "left" if offset_center > 0 else "straight"
+    draw_lane_overlay(image_np, image_size, offset_center, current_center_x, direction)
 
-    if (selected_indices[0] == selected_indices[1]):
-        print("Warning: ego lane indexes are the same, this should not happen!")
+    color_fill_image_transformed = cv2.warpPerspective(color_fill_image, transform_matrix, (width, height), flags=cv2.WARP_INVERSE_MAP)
+    result = cv2.addWeighted(image_np, 1, color_fill_image_transformed, 0.2, 0, dtype=cv2.CV_8U)
 
-    left_lane_poly = fit_lane(left_lane_bev)
-    right_lane_poly = fit_lane(right_lane_bev)
+    return result
 
+def render_lane_bev(image, keypoints, image_size: tuple, transform_matrix, ego_lane):
+    selected_indices, color_fill_image, offset_center, current_center_x = ego_lane
     width = image_size[0]
     height = image_size[1]
-    color_fill_image = np.zeros([height, width, 3])
-
-    y_range = np.linspace(0, height - 1, height)
-    left_fit = left_lane_poly(y_range)
-    right_fit = right_lane_poly(y_range)
 
-    l1 = np.transpose(np.vstack([left_fit, y_range]))
-    l2 = np.flip(np.transpose(np.vstack([right_fit, y_range])), axis=0) 
-    pts = np.int_(np.vstack((l1, l2)))
-
-    image_np = np.array(image)
-    image_np = cv2.warpPerspective(image_np, transform_matrix, (width, height))
+    image_np = cv2.warpPerspective(np.asarray(image), transform_matrix, (width, height))
 
     colors = [(255,0,0), (0,255,0), (0,0,255), (0,255,255), (255,255,0), (255,0,255)]
 
@@ -277,28 +272,84 @@ def draw_lane_bev(image, keypoints, image_size: tuple, transform_matrix=None):
         for point in lane_bev:
             cv2.circle(image_np, (int(point[0]), int(point[1])), w, colors[i], -1)
 
-    offset_center, theta, debug_info = get_offset_center(keypoints, image_size, transform_matrix=transform_matrix)
-    cv2.putText(image_np, f'Offset center: {offset_center}px (+ means deviation to right,- means to the left)', (10, 20), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
-    # cv2.putText(image_np, f'Theta: {theta} ({np.rad2deg(theta)})', (10, 40), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
     direction = "left" if offset_center < 0 else "right" if offset_center > 0 else "straight"
-    cv2.putText(image_np, f'Steering direction: {direction}. Green circle is desired center. White is current lane center.', (10, 40), cv2.FONT_HERSHEY_SIMPLEX , 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    draw_lane_overlay(image_np, image_size, offset_center, current_center_x, direction)
 
-    # desired center
-    cv2.circle(image_np, (int(width/2), int(height-3)), 3, (0, 255, 0), -1, cv2.LINE_AA)
-
-    # current lane center
-    # debug_info = {radius, angle_rad, start_point, end_point}
-    left_lane_start = left_lane_poly(height)
-    right_lane_start = right_lane_poly(height)
-    current_center_x = left_lane_start + (right_lane_start - left_lane_start) / 2
-    cv2.circle(image_np, (int(current_center_x), int(height-3)), 3, (255, 255, 255), -1, cv2.LINE_AA)
-    # end_point_transformed = perspective_warp(np.array([debug_info[3]]), transform_matrix_inv)[0]
-    # cv2.arrowedLine(image_np, (int(width/2), int(height-3)), np.int_(end_point_transformed), (0, 0, 0), 1, cv2.LINE_AA)  
-
-    color_fill_image = cv2.fillPoly(color_fill_image, [pts], (0, 255, 0))  
     result = cv2.addWeighted(image_np, 1, color_fill_image, 0.2, 0, dtype=cv2.CV_8U)
     return result
 
+def draw_lane(image, keypoints, image_size: tuple, transform_matrix=None):
+    if len(keypoints) < 2:
+        return draw_no_lanes(image)
+
+    if transform_matrix is None: 
+        transform_matrix, _ = get_transform_matrix(image_size)
+
+    ego_lane = fit_ego_lane(keypoints, image_size, transform_matrix)
+    return render_lane(image, keypoints, image_size, transform_matrix, ego_lane)
+
+def draw_lane_bev(image, keypoints, image_size: tuple, transform_matrix=None):
+    if len(keypoints) < 2:
+        return draw_no_lanes(image)
+
+    if transform_matrix is None: 
+        transform_matrix, _ = get_transform_matrix(image_size)
+
+    ego_lane = fit_ego_lane(keypoints, image_size, transform_matrix)
+    return render_lane_bev(image, keypoints, image_size, transform_matrix, ego_lane)
+
+def draw_lane_both(image, keypoints, image_size: tuple, transform_matrix=None):
+    """Same as (draw_lane(...), draw_lane_bev(...)), but fits the ego lane only once"""
+    if len(keypoints) < 2:
+        image_np = draw_no_lanes(image)
+        return image_np, image_np.copy()
+
+    if transform_matrix is None: 
+        transform_matrix, _ = get_transform_matrix(image_size)
+
+    ego_lane = fit_ego_lane(keypoints, image_size, transform_matrix)
+    return (
+        render_lane(image, keypoints, image_size, transform_matrix, ego_lane),
+        render_lane_bev(image, keypoints, image_size, transform_matrix, ego_lane),
+    )
+
+@njit(cache=True)
+def rotation_matrix(y, p, r):
+    """Closed form of Rs * Rz * Ry * Rx, where Rs switches axes (x = -y, y = -z, z = x)"""
+    cy, sy = np.cos(-y), np.sin(-y)
+    cp, sp = np.cos(-p), np.sin(-p)
+    cr, sr = np.cos(-r), np.sin(-r)
+
+    R = np.empty((3, 3))
+    R[0, 0] = -sy * cp
+    R[0, 1] = -sy * sp * sr - cy * cr
+    R[0, 2] = -sy * sp * cr + cy * sr
+    R[1, 0] = sp
+    R[1, 1] = -cp * sr
+    R[1, 2] = -cp * cr
+    R[2, 0] = cy * cp
+    R[2, 1] = cy * sp * sr - sy * cr
+    R[2, 2] = cy * sp * cr + sy * sr
+    return R
+
+@njit(cache=True)
+def translation_vector(R, XCam, YCam, ZCam):
+    """t = -R * X"""
+    t = np.empty(3)
+    for i in range(3):
+        t[i] = -(R[i, 0] * XCam + R[i, 1] * YCam + R[i, 2] * ZCam)
+    return t
+
+@njit(cache=True)
+def projection_matrix(K, R, t):
+    """P = K * [R | t]"""
+    P = np.empty((3, 4))
+    for i in range(3):
+        for j in range(3):
+            P[i, j] = K[i, 0] * R[0, j] + K[i, 1] * R[1, j] + K[i, 2] * R[2, j]
+        P[i, 3] = K[i, 0] * t[0] + K[i, 1] * t[1] + K[i, 2] * t[2]
+    return P
+
 class Camera:
   K = np.zeros([3, 3])
   R = np.zeros([3, 3])
@@ -306,45 +357,34 @@ class Camera:
   P = np.zeros([3, 4])
 
   def setK(self, fx, fy, px, py):
-    self.K[0, 0] = fx
-    self.K[1, 1] = fy
-    self.K[0, 2] = px
-    self.K[1, 2] = py
-    self.K[2, 2] = 1.0
+    self.K = np.array([[fx, 0.0, px], [0.0, fy, py], [0.0, 0.0, 1.0]])
 
   def setR(self, y, p, r):
-
-    Rz = np.array([[np.cos(-y), -np.sin(-y), 0.0], [np.sin(-y), np.cos(-y), 0.0], [0.0, 0.0, 1.0]])
-    Ry = np.array([[np.cos(-p), 0.0, np.sin(-p)], [0.0, 1.0, 0.0], [-np.sin(-p), 0.0, np.cos(-p)]])
-    Rx = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(-r), -np.sin(-r)], [0.0, np.sin(-r), np.cos(-r)]])
-    Rs = np.array([[0.0, -1.0, 0.0], [0.0, 0.0, -1.0], [1.0, 0.0, 0.0]]) # switch axes (x = -y, y = -z, z = x)
-    self.R = Rs.dot(Rz.dot(Ry.dot(Rx)))
+    self.R = rotation_matrix(y, p, r)
 
   def setT(self, XCam, YCam, ZCam):
-    X = np.array([XCam, YCam, ZCam])
-    self.t = -self.R.dot(X)
+    self.t = translation_vector(self.R, XCam, YCam, ZCam)
 
   def updateP(self):
-    Rt = np.zeros([3, 4])
-    Rt[0:3, 0:3] = self.R
-    Rt[0:3, 3] = self.t
-    self.P = self.K.dot(Rt)
+    self.P = projection_matrix(self.K, self.R, self.t)
 
-  def __init__(self, config):
+  def __init__(self, config, debug_scale_factor=1.0):
+    # debug_scale_factor scales the camera height and offset (YCam, ZCam), e.g. for a drone-like view
     self.config = config
     self.setK(config["fx"], config["fy"], config["px"], config["py"])
     self.setR(np.deg2rad(config["yaw"]), np.deg2rad(config["pitch"]), np.deg2rad(config["roll"]))
-    self.setT(config["XCam"], config["YCam"], config["ZCam"])
+    self.setT(config["XCam"], config["YCam"] * debug_scale_factor, config["ZCam"] * debug_scale_factor)
     self.updateP()
 
-def get_ipm_via_camera_config(image, fx, fy, res=1):
+def get_ipm_via_camera_config(image_size: tuple, fx, fy, res=1):
     """
-    Get the Inverse Perspective Mapping (IPM) of an image using a camera configuration
+    Get the Inverse Perspective Mapping (IPM) for images of the given size using a camera configuration
+    image_size: 2-element tuple in the format (width, height)
     fx: focal length in x-direction [px]
     fy: focal length in y-direction [px]
     res [px/m]
     """
-    width, height = image.shape[1], image.shape[0]
+    width, height = image_size
 
     config = {
         "fx": fx,	
@@ -31,46 +31,12 @@ import yaml
 import numpy as np
 import cv2
 import argparse
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-
-class Camera:
-  K = np.zeros([3, 3])
-  R = np.zeros([3, 3])
-  t = np.zeros([3, 1])
-  P = np.zeros([3, 4])
-
-  def setK(self, fx, fy, px, py):
-    self.K[0, 0] = fx
-    self.K[1, 1] = fy
-    self.K[0, 2] = px
-    self.K[1, 2] = py
-    self.K[2, 2] = 1.0
-
-  def setR(self, y, p, r):
-
-    Rz = np.array([[np.cos(-y), -np.sin(-y), 0.0], [np.sin(-y), np.cos(-y), 0.0], [0.0, 0.0, 1.0]])
-    Ry = np.array([[np.cos(-p), 0.0, np.sin(-p)], [0.0, 1.0, 0.0], [-np.sin(-p), 0.0, np.cos(-p)]])
-    Rx = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(-r), -np.sin(-r)], [0.0, np.sin(-r), np.cos(-r)]])
-    Rs = np.array([[0.0, -1.0, 0.0], [0.0, 0.0, -1.0], [1.0, 0.0, 0.0]]) # switch axes (x = -y, y = -z, z = x)
-    self.R = Rs.dot(Rz.dot(Ry.dot(Rx)))
-
-  def setT(self, XCam, YCam, ZCam):
-    X = np.array([XCam, YCam, ZCam])
-    self.t = -self.R.dot(X)
-
-  def updateP(self):
-    Rt = np.zeros([3, 4])
-    Rt[0:3, 0:3] = self.R
-    Rt[0:3, 3] = self.t
-    self.P = self.K.dot(Rt)
-
-  def __init__(self, config):
-    self.setK(config["fx"], config["fy"], config["px"], config["py"])
-    self.setR(np.deg2rad(config["yaw"]), np.deg2rad(config["pitch"]), np.deg2rad(config["roll"]))
-    DEBUG_SCALE_FACTOR = 8.0
-    self.setT(config["XCam"], config["YCam"] * DEBUG_SCALE_FACTOR, config["ZCam"] * DEBUG_SCALE_FACTOR)
-    self.updateP()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lanefitting import Camera
 
 
 # parse command line arguments
@@ -83,6 +49,7 @@ parser.add_argument("--batch", help="process folders of images instead of single
 parser.add_argument("--output", help="output directory to write transformed images to")
 parser.add_argument("--cc", help="use with color-coded images to enable NN-interpolation", action="store_true")
 parser.add_argument("-v", help="only print homography matrices", action="store_true")
+parser.add_argument("--no-show", help="do not display the warped image (also set by the HEADLESS environment variable)", action="store_true")
 args = parser.parse_args()
 
 
@@ -112,8 +79,12 @@ if args.output:
   if not os.path.exists(outputDir):
     os.makedirs(outputDir)
 
-shape = cv2.imread(imagePaths[0][0]).shape
-width, height = shape[1], shape[0]
+# PIL only parses the image header here, the pixel data is not decoded
+with Image.open(imagePaths[0][0]) as img:
+  width, height = img.size
+  # cv2.imread applies the EXIF orientation, the orientations 5-8 rotate by 90 degrees
+  if img.getexif().get(0x0112) in (5, 6, 7, 8):
+    width, height = height, width
 
 print(f"Processing {len(imagePaths)} images with resolution {width}x{height}...")
 
@@ -122,14 +93,15 @@ cams = []
 for config in cameraConfigs:
     config["px"] = width / 2
     config["py"] = height / 2
-    cams.append(Camera(config))
+    cams.append(Camera(config, debug_scale_factor=8.0))
 
-pxPerM = (args.r, args.r)
-outputRes = (int(height * pxPerM[0]), int(width * pxPerM[1]))
+# output image size [px] from the requested size [m] and resolution [px/m]
+pxPerM = float(args.r)
+outputRes = (int(args.hm * pxPerM), int(args.wm * pxPerM))
 
 # setup mapping from street/top-image plane to world coords
-shift = (outputRes[0] / 2.0, outputRes[1] / 2.0) # was (outputRes[0] / 2.0, outputRes[1] / 2.0)
-M = np.array([[1.0 / pxPerM[1], 0.0, -shift[1] / pxPerM[1]], [0.0, -1.0 / pxPerM[0], shift[0] / pxPerM[0]], [0.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+shiftY, shiftX = outputRes[0] / 2.0, outputRes[1] / 2.0
+M = np.array([[1.0 / pxPerM, 0.0, -shiftX / pxPerM], [0.0, -1.0 / pxPerM, shiftY / pxPerM], [0.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
 
 # find IPM as inverse of P*M
 IPMs = []
@@ -143,27 +115,50 @@ if args.v:
     print(ipm.tolist())
   exit(0)
 
+interpMode = cv2.INTER_NEAREST if args.cc else cv2.INTER_LINEAR
+
+# the homographies are static, so the per-pixel lookup maps are computed once and reused for every image
+def makeMaps(IPM, outputRes):
+  # R=IPM makes initUndistortRectifyMap sample the source at inv(IPM) * (u, v, 1), same as warpPerspective
+  mapx, mapy = cv2.initUndistortRectifyMap(np.eye(3), np.zeros(5), IPM, np.eye(3), (outputRes[1], outputRes[0]), cv2.CV_32FC1)
+  # fixed-point maps halve the memory traffic of the remap
+  return cv2.convertMaps(mapx, mapy, cv2.CV_16SC2, nninterpolation=(interpMode == cv2.INTER_NEAREST))
 
-# process images
-progBarWrapper = tqdm(imagePaths)
-for imageTuple in progBarWrapper:
+# warp on the GPU if OpenCV was built with CUDA, otherwise use the precomputed maps on the CPU
+useCuda = hasattr(cv2, "cuda") and cv2.cuda.getCudaEnabledDeviceCount() > 0
+if not useCuda:
+  maps = [makeMaps(IPM, outputRes) for IPM in IPMs]
 
-  filename = os.path.basename(imageTuple[0])
-  progBarWrapper.set_postfix_str(filename)
 
+def processImages(imageTuple):
   # load images
   images = []
   for imgPath in imageTuple:
     images.append(cv2.imread(imgPath))
 
   # warp input images
-  interpMode = cv2.INTER_NEAREST if args.cc else cv2.INTER_LINEAR
   warpedImages = []
-  print(outputRes)
-  for img, IPM in zip(images, IPMs):
-    warpedImages.append(cv2.warpPerspective(img, IPM, (outputRes[1], outputRes[0]), flags=interpMode))
-
-# cv2.namedWindow(filename, cv2.WINDOW_NORMAL)
-cv2.imshow(filename, warpedImages[0])
-cv2.waitKey(10000)
-cv2.destroyAllWindows()
\ No newline at end of file
+  if useCuda:
+    # results stay on the GPU and are only downloaded for display
+    for img, IPM in zip(images, IPMs):
+      gpuSrc = cv2.cuda_GpuMat()
+      gpuSrc.upload(img)
+      warpedImages.append(cv2.cuda.warpPerspective(gpuSrc, IPM, (outputRes[1], outputRes[0]), flags=interpMode))
+  else:
+    for img, (mapx, mapy) in zip(images, maps):
+      warpedImages.append(cv2.remap(img, mapx, mapy, interpMode))
+  return warpedImages
+
+
+# process images, imread and the warps release the GIL so the frames are processed in parallel threads
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+  progBarWrapper = tqdm(executor.map(processImages, imagePaths), total=len(imagePaths))
+  for warpedImages, imageTuple in zip(progBarWrapper, imagePaths):
+    filename = os.path.basename(imageTuple[0])
+    progBarWrapper.set_postfix_str(filename)
+
+if not (args.no_show or os.environ.get("HEADLESS")):
+  # cv2.namedWindow(filename, cv2.WINDOW_NORMAL)
+  cv2.imshow(filename, warpedImages[0].download() if useCuda else warpedImages[0])
+  cv2.waitKey(10000) # returns early on key press
+  cv2.destroyAllWindows()
@@ -1,8 +1,12 @@
 
 import os
 import glob
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
 import cv2
+import numpy as np
 from metadrive import MetaDriveEnv
 from metadrive.component.sensors.rgb_camera import RGBCamera
 from metadrive.constants import HELP_MESSAGE
@@ -15,6 +19,29 @@ from metadrive_policy.TopDownCamera import TopDownCamera
 from metadrive_policy.lanedetection_policy_patch_e2e import LaneDetectionPolicyE2E
 from metadrive_policy.lanedetection_policy_dpatch import LaneDetectionPolicy
 
+MAX_PENDING_WRITES = 8
+
+# config entries that do not depend on the Settings
+_BASE_CONFIG = dict(
+    vehicle_config={
+        "image_source": "rgb_camera",
+    },
+    image_on_cuda=True,
+    image_observation=True,
+    out_of_route_done=True,
+    on_continuous_line_done=True,
+    crash_vehicle_done=True,
+    crash_object_done=True,
+    crash_human_done=True,
+    traffic_density=0.0,
+    decision_repeat=1,
+    preload_models=False,
+    manual_control=True,
+    show_fps=True,
+    show_interface_navi_mark=False,
+    interface_panel=["dashboard", "rgb_camera", "topdown_camera"],
+)
+
 @dataclass
 class AttackConfig:
     attack_at_step: int = 6000
@@ -25,6 +52,7 @@ class Settings:
     seed: int = 1235
     num_scenarios: int = 1
     map_config: str = "SCS"
+    regenerate_map: bool = False # regenerate the maps on every reset instead of using the PG Map cache
     headless_rendering: bool = False
     save_images: bool = False
     max_steps: int = 5000
@@ -44,58 +72,58 @@ class MetaDriveBridge:
             BaseMap.LANE_NUM: 2,
         }
 
+        # camera observations are encoded and written in the background, off the simulation loop
+        self._writer = None
+        self._pending = deque()
+
         self.policy = LaneDetectionPolicyE2E if self.settings.policy == "LaneDetectionPolicyE2E" else LaneDetectionPolicy
 
-        self.config  = dict(
-            use_render=not self.settings.headless_rendering,
-            window_size=self.settings.simulator_window_size,
-            sensors={
-                "rgb_camera": (RGBCamera, self.settings.simulator_window_size[0], self.settings.simulator_window_size[1]),
-                # "topdown_camera": (TopDownCamera, self.settings.simulator_window_size[0], self.settings.simulator_window_size[1]),
-            },
-            vehicle_config={
-                "image_source": "rgb_camera",
+        window_size = self.settings.simulator_window_size
+        self.config = {
+            # deep copy, MetaDrive merges into the nested dicts and lists in place
+            **copy.deepcopy(_BASE_CONFIG),
+            "use_render": not self.settings.headless_rendering,
+            "window_size": window_size,
+            "sensors": {
+                "rgb_camera": (RGBCamera, window_size[0], window_size[1]),
+                # "topdown_camera": (TopDownCamera, window_size[0], window_size[1]),
             },
-            agent_policy=self.policy,
-            start_seed=self.settings.seed,
-            image_on_cuda=True,
-            image_observation=True,
-            out_of_route_done=True,
-            on_continuous_line_done=True,
-            crash_vehicle_done=True,
-            crash_object_done=True,
-            crash_human_done=True,
-            traffic_density=0.0,
-            map_config=self.map_config,
-            num_scenarios=self.settings.num_scenarios,
-            decision_repeat=1,
-            preload_models=False,
-            manual_control=True,
-            force_map_generation=True, # disables the PG Map cache
-            show_fps=True,
-            show_interface_navi_mark=False,
-            interface_panel=["dashboard", "rgb_camera", "topdown_camera"],
-        )
+            "agent_policy": self.policy,
+            "start_seed": self.settings.seed,
+            "map_config": self.map_config,
+            "num_scenarios": self.settings.num_scenarios,
+            "force_map_generation": self.settings.regenerate_map, # True disables the PG Map cache
+        }
 
     def cleanup(self):
         # delete all the previous camera observations
         for f in glob.glob("./camera_observations/*.jpg"):
             os.remove(f)
 
-    def run(self):
-        self.cleanup()
+    def save_image_async(self, path, image):
+        # bound the number of frames waiting to be written
+        if len(self._pending) >= MAX_PENDING_WRITES:
+            self._pending.popleft().result()
+        self._pending.append(self._writer.submit(cv2.imwrite, path, image))
 
-        if self.settings.attack_config is not None:
-            self.config["dirty_road_patch_attack_step_index"]= self.settings.attack_config.attack_at_step
-            if self.settings.attack_config.two_pass_attack:
-                self.run_two_pass_attack()
+    def run(self):
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        try:
+            self.cleanup()
+
+            if self.settings.attack_config is not None:
+                self.config["dirty_road_patch_attack_step_index"]= self.settings.attack_config.attack_at_step
+                if self.settings.attack_config.two_pass_attack:
+                    self.run_two_pass_attack()
+                else:
+                    self.config["enable_dirty_road_patch_attack"] = True
+                    env = MetaDriveEnv(self.config)
+                    self.run_simulation(env)
             else:
-                self.config["enable_dirty_road_patch_attack"] = True
                 env = MetaDriveEnv(self.config)
                 self.run_simulation(env)
-        else:
-            env = MetaDriveEnv(self.config)
-            self.run_simulation(env)
+        finally:
+            self._writer.shutdown(wait=True)
 
     def run_two_pass_attack(self):
         self.cleanup()
@@ -111,47 +139,48 @@ class MetaDriveBridge:
         self.run_simulation(env)
 
     def run_simulation(self, env: MetaDriveEnv):
-
-        env.reset(self.settings.seed)
-        env.current_track_agent.expert_takeover = not self.settings.start_with_manual_control
+        try:
+            env.reset(self.settings.seed)
+            env.current_track_agent.expert_takeover = not self.settings.start_with_manual_control
         
-        for i in range(15):
-            o, r, tm, tc, infos = env.step([0, 1])
-        assert isinstance(o, dict)
-
-
-
-        step_index = 0
-        while True:
-            o, r, tm, tc, info = env.step([0,0])
-
-            if not self.settings.headless_rendering:
-                env.render(
-                    text={
-                        "Auto-Drive (Switch mode: T)": (
-                            "on" if env.current_track_agent.expert_takeover else "off"
-                        ),
-                        "Keyboard Control": "W,A,S,D",
-                    }
-                )
-
-            if self.settings.save_images:
-                if step_index % 20 == 0:
-                    cv2.imwrite(
-                        f"camera_observations/{str(step_index)}.jpg",
-                        (
-                            o["image"].get()[..., -1]
-                            if env.config["image_on_cuda"]
-                            else o["image"][..., -1]
-                        )
-                        * 255,
+            for i in range(15):
+                o, r, tm, tc, infos = env.step([0, 1])
+            assert isinstance(o, dict)
+
+
+
+            step_index = 0
+            while True:
+                o, r, tm, tc, info = env.step([0,0])
+
+                if not self.settings.headless_rendering:
+                    env.render(
+                        text={
+                            "Auto-Drive (Switch mode: T)": (
+                                "on" if env.current_track_agent.expert_takeover else "off"
+                            ),
+                            "Keyboard Control": "W,A,S,D",
+                        }
                     )
 
-            if tm or tc or step_index >= self.settings.max_steps:
-                print(f"Simulation ended at step {step_index}")
-                if env.current_seed + 1 < self.settings.seed + self.settings.num_scenarios:
-                    env.reset(env.current_seed + 1)
-                    env.current_track_agent.expert_takeover = not self.settings.start_with_manual_control
-                else:
-                    break            
-            step_index += 1
+                if self.settings.save_images:
+                    if step_index % 20 == 0:
+                        # convert before the device to host copy, so only the uint8 frame is transferred
+                        image = (o["image"][..., -1] * 255).astype(np.uint8)
+                        self.save_image_async(
+                            f"camera_observations/{str(step_index)}.jpg",
+                            image.get() if env.config["image_on_cuda"] else image,
+                        )
+
+                if tm or tc or step_index >= self.settings.max_steps:
+                    print(f"Simulation ended at step {step_index}")
+                    if env.current_seed + 1 < self.settings.seed + self.settings.num_scenarios:
+                        env.reset(env.current_seed + 1)
+                        env.current_track_agent.expert_takeover = not self.settings.start_with_manual_control
+                    else:
+                        break            
+                step_index += 1
+        finally:
+            # also write the queued frames if the simulation stops with an exception
+            wait(self._pending)
+            self._pending.clear()
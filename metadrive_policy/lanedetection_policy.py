@@ -4,12 +4,11 @@ from metadrive.engine.engine_utils import get_global_config
 from metadrive.obs.image_obs import ImageStateObservation
 from metadrive.component.vehicle.PID_controller import PIDController
 from metadrive.utils.math import not_zero, wrap_to_pi
-from PIL import Image
 import numpy as np
 import sys, os
 
 sys.path.append(os.path.dirname(os.getcwd()))
-from inference import ONNXPipeline
+from inference import get_pipeline
 from lanefitting import draw_lane
 
 
@@ -19,10 +18,13 @@ class LaneDetectionPolicy(BasePolicy):
     ACC_FACTOR = 1.0
     DEACC_FACTOR = -5
     DELTA = 10.0  # Exponent of the velocity term
+    STEERING_VALUE_RAD = np.deg2rad(15)
+    STEER_LEFT = -wrap_to_pi(-STEERING_VALUE_RAD)
+    STEER_RIGHT = -wrap_to_pi(STEERING_VALUE_RAD)
 
     def __init__(self, control_object, random_seed=None, config=None):
         super(LaneDetectionPolicy, self).__init__(control_object, random_seed, config)
-        self.onnx_pipeline = ONNXPipeline()
+        self.onnx_pipeline = get_pipeline()
         self.camera_observation = ImageStateObservation(get_global_config().copy())
         self.target_speed = self.NORMAL_SPEED
         self.heading_pid = PIDController(1.7, 0.01, 3.5)
@@ -37,8 +39,9 @@ class LaneDetectionPolicy(BasePolicy):
 
         # get RGB camera image from vehicle
         observation = self.camera_observation.observe(self.control_object)
-        image = Image.fromarray((observation["image"][..., -1] * 255).astype(np.uint8))
-        image_size = (image.width, image.height)
+        # float image in [0, 1], passed to the pipeline as is (on the GPU if image_on_cuda is set)
+        image = observation["image"][..., -1]
+        image_size = (image.shape[1], image.shape[0])
 
         offset_center, lane_heading_theta, keypoints = (
             self.onnx_pipeline.infer_offset_center(image, (image_size[1], image_size[0])) # important: swap image_size order
@@ -53,11 +56,10 @@ class LaneDetectionPolicy(BasePolicy):
         #     -wrap_to_pi(lane_heading_theta - v_heading)
         # )
 
-        STEERING_VALUE_RAD = np.deg2rad(15)
         if offset_center > 0.01:
-            steering = self.lateral_pid.get_result(-wrap_to_pi(-STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_LEFT)
         elif offset_center < -0.01:
-            steering = self.lateral_pid.get_result(-wrap_to_pi(+STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_RIGHT)
         else:
             steering = self.lateral_pid.get_result(0)
 
@@ -1,4 +1,5 @@
 import cv2
+from functools import lru_cache
 from metadrive.policy.base_policy import BasePolicy
 from metadrive.engine.engine_utils import get_global_config
 from metadrive.obs.image_obs import ImageStateObservation
@@ -15,12 +16,18 @@ sys.path.append(os.path.dirname(os.getcwd()))
 from inference_pytorch import PyTorchPipeline
 from lanefitting import draw_lane
 
-# TARGET=None
-TARGET=np.load("attack/targets/turn_right.npy", allow_pickle=True).item()
+# TARGET_PATH=None
+TARGET_PATH="attack/targets/turn_right.npy"
 START_ATTACK_AFTER = 50
 REGENERATE_INTERVAL = 100
 
 
+@lru_cache(maxsize=1)
+def load_target(path):
+    # the target contains torch tensors, so it has to be unpickled; loaded once on the first attack step
+    return np.load(path, allow_pickle=True).item()
+
+
 class LaneDetectionPolicy(BasePolicy):
     MAX_SPEED = 100  # km/h
     NORMAL_SPEED = 50  # km/h
@@ -29,14 +36,13 @@ class LaneDetectionPolicy(BasePolicy):
     DELTA = 10.0  # Exponent of the velocity term
     # TODO: scale this proportional to offset
     STEERING_VALUE_RAD = np.deg2rad(60)
+    # lateral PID targets for steering left and right, in range (-pi, pi]
+    STEER_LEFT = -wrap_to_pi(-STEERING_VALUE_RAD)
+    STEER_RIGHT = -wrap_to_pi(STEERING_VALUE_RAD)
 
     def __init__(self, control_object, random_seed=None, config=None):
         super(LaneDetectionPolicy, self).__init__(control_object, random_seed, config)
-        self.target = TARGET
-        if self.target is not None:
-            self.pipeline = PyTorchPipeline(targeted=True)
-        else:
-            self.pipeline = PyTorchPipeline()       
+        self.pipeline = PyTorchPipeline(targeted=TARGET_PATH is not None)
         self.camera_observation = ImageStateObservation(get_global_config().copy())
         self.target_speed = self.NORMAL_SPEED
         self.heading_pid = PIDController(1.7, 0.01, 3.5)
@@ -69,6 +75,10 @@ class LaneDetectionPolicy(BasePolicy):
             self.engine.current_track_agent.expert_takeover = not self.engine.current_track_agent.expert_takeover
             print("The expert takeover is set to: ", self.engine.current_track_agent.expert_takeover)
 
+    @property
+    def target(self):
+        return load_target(TARGET_PATH) if TARGET_PATH is not None else None
+
     def expert(self):
 
         if not self.engine.current_track_agent.expert_takeover:
@@ -117,9 +127,9 @@ class LaneDetectionPolicy(BasePolicy):
             # brake if no lane detected
             self.target_speed = 0.01
         elif offset_center > steering_threshold:
-            steering = self.lateral_pid.get_result(-wrap_to_pi(-self.STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_LEFT)
         elif offset_center < -steering_threshold:
-            steering = self.lateral_pid.get_result(-wrap_to_pi(+self.STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_RIGHT)
         else:
             steering = self.lateral_pid.get_result(0)
 
@@ -1,65 +1,140 @@
 import pickle
-import queue
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
 import cv2
 from metadrive.engine.engine_utils import get_global_config
 from metadrive.utils.math import wrap_to_pi
-from PIL import Image
 import numpy as np
 import matplotlib.pyplot as plt
 import sys, os
 import torch
+try:
+    from cupyx import empty_pinned
+except ImportError:
+    empty_pinned = None
 
 from metadrive_policy.lanedetection_policy_dpatch import LaneDetectionPolicy
 
 sys.path.append(os.path.dirname(os.getcwd()))
 from inference_pytorch import PyTorchPipeline
-from lanefitting import draw_lane, draw_lane_bev, get_ipm_via_camera_config
+from lanefitting import draw_lane_both, get_ipm_via_camera_config
+
+log = logging.getLogger(__name__)
+
+# the debug images do not need the default quality of 95, this roughly halves the encoding time
+DEBUG_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 80, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+
+
+# scripted to drop the Python overhead between the small kernels, torch.compile is not available on Windows
+@torch.jit.script
+def reduce_probmaps(logits: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    prob_maps_softmax = torch.nn.functional.softmax(logits, dim=1)
+
+    # maximum over the lane channels (channel 0 is the background class), taken before upsampling
+    # so only one channel per map is interpolated to the full image size
+    reduced = torch.cat(
+        (logits[:, 1:].amax(dim=1, keepdim=True), prob_maps_softmax[:, 1:].amax(dim=1, keepdim=True)), dim=1
+    )
+    if reduced.is_cuda:
+        reduced = reduced.half() # the upsampling is memory bound, half precision halves the traffic
+    return torch.nn.functional.interpolate(reduced, size=[height, width], mode='bilinear', align_corners=True)
+
+
+@contextmanager
+def fast_cudnn():
+    """Enables cudnn.benchmark and TF32 inside the block and restores the previous (process-wide) flags afterwards"""
+    saved = (torch.backends.cudnn.benchmark, torch.backends.cudnn.allow_tf32, torch.backends.cuda.matmul.allow_tf32)
+    # the model input has a fixed shape, so the conv algorithms picked by cudnn.benchmark are reused every step
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    try:
+        yield
+    finally:
+        torch.backends.cudnn.benchmark, torch.backends.cudnn.allow_tf32, torch.backends.cuda.matmul.allow_tf32 = saved
 
-TARGET=np.load("attack/targets/turn_right.npy", allow_pickle=True).item()
 
 class LaneDetectionPolicyE2E(LaneDetectionPolicy):
+    STEERING_VALUE_RAD = np.deg2rad(15)
+    STEER_LEFT = -wrap_to_pi(-STEERING_VALUE_RAD)
+    STEER_RIGHT = -wrap_to_pi(STEERING_VALUE_RAD)
+
     def __init__(self, control_object, random_seed=None, config=None):
         super(LaneDetectionPolicyE2E, self).__init__(control_object, random_seed, config)
-        self.io_tasks = queue.Queue()
-        self.stop_event = threading.Event()
-        self.io_thread = threading.Thread(target=self.io_worker, daemon=True)
-        self.io_thread.start()
+        self.pipeline.model = self.pipeline.model.to(memory_format=torch.channels_last)
+        self.pipeline.memory_format = torch.channels_last
+        self._io_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count()))
         self.ipm = None
 
-    def io_worker(self):
-        while not self.stop_event.isSet():
-            try:
-                task = self.io_tasks.get(block=True, timeout=1)
-                task()
-                self.io_tasks.task_done()
-            except queue.Empty:
-                pass
+        # the global config does not change during an episode, a new policy is created on every reset
+        config = get_global_config()
+        self.image_on_cuda = config["image_on_cuda"]
+        self.attack_step_index = config["dirty_road_patch_attack_step_index"]
+        self.save_probmaps = config["save_probmaps"]
+        self.window_size = config["window_size"]
+        self.fx, self.fy = None, None
+        self._frame_buf = None
+        self._pinned_frame = None
+
+        # BGR lookup table of the 'seismic' colormap for saving probmaps with cv2
+        self.seismic_lut = (plt.get_cmap('seismic')(np.linspace(0, 1, 256))[:, 2::-1] * 255).astype(np.uint8)
+
+        # probmaps for the debug output are reduced and copied on a side stream, so the next inference does not wait for them
+        self._debug_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def ensure_intrinsics(self):
+        # the camera sensor is only available once the engine is running, so this is done on first use
+        if self.fx is None:
+            fov_angle = self.control_object.engine.get_sensor("rgb_camera").get_lens().getFov()
+            self.fx = self.window_size[0] / (2 * np.tan(fov_angle[0] * np.pi / 360))
+            self.fy = self.window_size[1] / (2 * np.tan(fov_angle[1] * np.pi / 360))
+
+    def frame_to_host(self, image):
+        # convert on the GPU, so only a uint8 frame is copied to the host, same as the frame of the CPU path
+        frame = (image * 255).astype(np.uint8)
+        if empty_pinned is None:
+            return frame.get()
+        # the copy into page-locked memory is faster, the buffer is reused because the frame is drawn on synchronously
+        if self._pinned_frame is None or self._pinned_frame.shape != frame.shape:
+            self._pinned_frame = empty_pinned(frame.shape, dtype=np.uint8)
+        return frame.get(out=self._pinned_frame)
+
+    def destroy(self):
+        # the policy is destroyed on every reset, finish the pending debug writes and stop the io threads
+        self._io_pool.shutdown(wait=True)
+        super(LaneDetectionPolicyE2E, self).destroy()
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.stop_event.set()
-        self.io_thread.join()
+        self._io_pool.shutdown(wait=True)
 
+    @torch.inference_mode()
     def get_probmap_images(self, probmaps, image_size):
-        prob_maps = torch.nn.functional.interpolate(probmaps['out'], 
-                                                    size=(image_size[1], image_size[0]), mode='bilinear', align_corners=True)
-        prob_maps_softmax = prob_maps.detach().clone().softmax(dim=1)
-        
-        merged = np.zeros_like(prob_maps[0][1].detach().cpu().numpy())
-        merged_softmax = np.zeros_like(prob_maps_softmax[0][1].detach().cpu().numpy())
-
-        for i, lane in enumerate(prob_maps[0]):
-            if i == 0: # skip first iteration (background class)
-                continue
-            pred = lane.detach().cpu().numpy()
-            pred_softmax = prob_maps_softmax[0][i].detach().cpu().numpy()
-            merged = np.maximum(merged, pred)
-            merged_softmax = np.maximum(merged_softmax, pred_softmax)
-
-        im = Image.fromarray(merged)
-        im_softmax = Image.fromarray(merged_softmax)
-
-        return im, im_softmax
+        logits = probmaps['out']
+        if self._debug_stream is None or not logits.is_cuda:
+            merged, merged_softmax = reduce_probmaps(logits, image_size[1], image_size[0])[0].float().cpu().numpy()
+            return merged, merged_softmax, None
+
+        self._debug_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._debug_stream):
+            merged_maps = reduce_probmaps(logits, image_size[1], image_size[0])[0].float()
+            # a new pinned buffer per call (served by torch's caching host allocator), a shared one could be
+            # overwritten while the io thread still encodes the previous maps
+            merged_pin = torch.empty(merged_maps.shape, dtype=merged_maps.dtype, pin_memory=True)
+            merged_pin.copy_(merged_maps, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self._debug_stream)
+        logits.record_stream(self._debug_stream)
+
+        merged, merged_softmax = merged_pin.numpy()
+        return merged, merged_softmax, ready
+
+    def save_colormap(self, path, image, ready=None):
+        if ready is not None:
+            ready.synchronize() # wait for the copy from the debug stream
+        # same output as plt.imsave(path, image, cmap='seismic'), which also scales to the min/max of the data
+        image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        cv2.imwrite(path, self.seismic_lut[image], DEBUG_JPEG_PARAMS)
 
     def expert(self):
 
@@ -75,52 +150,44 @@ class LaneDetectionPolicyE2E(LaneDetectionPolicy):
         # observation = self.camera_observation.observe(self.control_object, position=(0., 10., 50.), hpr=(0., -90.0, 0.0)) 
 
 
-        image_on_cuda = get_global_config()["image_on_cuda"]
-        attack_step_index = get_global_config()["dirty_road_patch_attack_step_index"]
+        image_on_cuda = self.image_on_cuda
 
         if not image_on_cuda:
-            image = Image.fromarray((observation["image"][..., -1] * 255).astype(np.uint8))
-            image_size = (image.width, image.height)
+            frame = observation["image"][..., -1]
+            if self._frame_buf is None or self._frame_buf.shape != frame.shape:
+                self._frame_buf = np.empty(frame.shape, dtype=np.uint8)
+            # scale and cast into the reused buffer, same truncation as astype(np.uint8)
+            image = np.multiply(frame, 255, out=self._frame_buf, casting="unsafe")
         else:
             image = observation["image"][..., -1]
-            image_size = (image.shape[1], image.shape[0])
+        image_size = (image.shape[1], image.shape[0])
 
-        sensor = self.control_object.engine.get_sensor("rgb_camera")
-        lens = sensor.get_lens()
-        fov_angle = lens.getFov()
+        self.ensure_intrinsics()
 
-        fx =  get_global_config()["window_size"][0]  / (2 * np.tan(fov_angle[0] * np.pi / 360))
-        fy = get_global_config()["window_size"][1] / (2 * np.tan(fov_angle[1] * np.pi / 360))
+        # the IPM only depends on the image size and the camera intrinsics, which are fixed per episode
+        if self.ipm is None:
+            self.ipm = get_ipm_via_camera_config(image_size, self.fx, self.fy)
 
-        if True or self.ipm is None:
-            ipm_input_image = None
-            if image_on_cuda:
-                ipm_input_image = image.get() * 255
-            else:
-                ipm_input_image = image.permute((2, 0, 1)).contiguous().float().div(255).unsqueeze(0).numpy()
-            self.ipm = get_ipm_via_camera_config(ipm_input_image, fx, fy)
 
+        # no autograd bookkeeping for the plain inference, the patch attack below still needs gradients
+        with torch.inference_mode(), fast_cudnn():
+            offset_center, lane_heading_theta, keypoints, debug_info = (
+                    self.pipeline.infer_offset_center(image, (image_size[1], image_size[0]), self.control_object, image_on_cuda, self.ipm) # important: swap image_size order
+                )
 
-        offset_center, lane_heading_theta, keypoints, debug_info = (
-                self.pipeline.infer_offset_center(image, (image_size[1], image_size[0]), self.control_object, image_on_cuda, self.ipm) # important: swap image_size order
-            )
-
-        if self.control_object.engine.episode_step == attack_step_index:
+        if self.control_object.engine.episode_step == self.attack_step_index:
             _, _, _, patch_object = (
                 self.pipeline.infer_offset_center_with_dpatch(image, (image_size[1], image_size[0]), self.control_object, True, target=self.target, image_on_cuda=image_on_cuda) # important: swap image_size order
             )
 
             self.control_object.engine.dirty_road_patch_object = patch_object
 
-            self.io_tasks.put(lambda: self.pipeline.save_image(
-                    patch_object.model_in,
-                    f"camera_observations/patched_input_{str(self.control_object.engine.episode_step)}.jpg",
-                )
-            )
+            step = str(self.control_object.engine.episode_step)
+            self._io_pool.submit(self.pipeline.save_image, patch_object.model_in, f"camera_observations/patched_input_{step}.jpg")
 
-            im, im_softmax = self.get_probmap_images(patch_object.probmaps, image_size)
-            plt.imsave(f"camera_observations/patched_probmap_{str(self.control_object.engine.episode_step)}_merged.jpg", im, cmap='seismic')
-            plt.imsave(f"camera_observations/patched_softmax_probmap_{str(self.control_object.engine.episode_step)}_merged.jpg", im_softmax, cmap='seismic')
+            im, im_softmax, ready = self.get_probmap_images(patch_object.probmaps, image_size)
+            self._io_pool.submit(self.save_colormap, f"camera_observations/patched_probmap_{step}_merged.jpg", im, ready)
+            self._io_pool.submit(self.save_colormap, f"camera_observations/patched_softmax_probmap_{step}_merged.jpg", im_softmax, ready)
 
 
         v_heading = self.control_object.heading_theta  # current vehicle heading
@@ -128,7 +195,6 @@ class LaneDetectionPolicyE2E(LaneDetectionPolicy):
         #     -wrap_to_pi(lane_heading_theta - v_heading)
         # )
 
-        STEERING_VALUE_RAD = np.deg2rad(15)
         self.target_speed = self.NORMAL_SPEED
         if offset_center is None:
             steering = self.lateral_pid.get_result(0)
@@ -136,10 +202,10 @@ class LaneDetectionPolicyE2E(LaneDetectionPolicy):
             self.target_speed = 0.01
         elif offset_center > 2:
             # steer to the left
-            steering = self.lateral_pid.get_result(-wrap_to_pi(-STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_LEFT)
         elif offset_center < -2:
             # steer to the right
-            steering = self.lateral_pid.get_result(-wrap_to_pi(+STEERING_VALUE_RAD)) # radian in range (-pi, pi]
+            steering = self.lateral_pid.get_result(self.STEER_RIGHT)
         else:
             steering = self.lateral_pid.get_result(0)
 
@@ -148,28 +214,23 @@ class LaneDetectionPolicyE2E(LaneDetectionPolicy):
 
         # TODO: add a flag to enable image saving and interval
         if self.control_object.engine.episode_step % 10 == 0:
-            print(f"Step: {self.control_object.engine.episode_step}, offset_center: {offset_center}, lane_heading_theta: {lane_heading_theta}, v_heading: {v_heading}, steering: {steering}")
-            lane_image = draw_lane(image.get() * 255 if image_on_cuda else image, keypoints, image_size, self.ipm) # swap image_size 
-            lane_image_bev = draw_lane_bev(image.get() * 255 if image_on_cuda else image, keypoints, image_size, self.ipm) 
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Step: %d, offset_center: %s, lane_heading_theta: %s, v_heading: %s, steering: %s",
+                          self.control_object.engine.episode_step, offset_center, lane_heading_theta, v_heading, steering)
+            host_image = self.frame_to_host(image) if image_on_cuda else image
+            lane_image, lane_image_bev = draw_lane_both(host_image, keypoints, image_size, self.ipm) # swap image_size 
             if lane_image is not None:
-                self.io_tasks.put(lambda: cv2.imwrite(
-                        f"camera_observations/lane_{str(self.control_object.engine.episode_step)}.jpg",
-                        lane_image
-                    )
-                )
+                self._io_pool.submit(cv2.imwrite, f"camera_observations/lane_{str(self.control_object.engine.episode_step)}.jpg", lane_image, DEBUG_JPEG_PARAMS)
                 # cv2.imshow("lane", lane_image_bev)
                 # cv2.waitKey(10)
-                self.io_tasks.put(lambda: cv2.imwrite(
-                        f"camera_observations/lane_bev_{str(self.control_object.engine.episode_step)}.jpg",
-                        lane_image_bev
-                    )
-                )
+                self._io_pool.submit(cv2.imwrite, f"camera_observations/lane_bev_{str(self.control_object.engine.episode_step)}.jpg", lane_image_bev, DEBUG_JPEG_PARAMS)
             else:
                 print(f"step {str(self.control_object.engine.episode_step)} lane_image is None")
 
-            if 'probmaps' in debug_info and get_global_config()["save_probmaps"]:
-                im, im_softmax = self.get_probmap_images(debug_info['probmaps'], image_size)
-                plt.imsave(f"camera_observations/probmap_{str(self.control_object.engine.episode_step)}_merged.jpg", im, cmap='seismic')
-                plt.imsave(f"camera_observations/softmax_probmap_{str(self.control_object.engine.episode_step)}_merged.jpg", im_softmax, cmap='seismic')
+            if 'probmaps' in debug_info and self.save_probmaps:
+                im, im_softmax, ready = self.get_probmap_images(debug_info['probmaps'], image_size)
+                step = str(self.control_object.engine.episode_step)
+                self._io_pool.submit(self.save_colormap, f"camera_observations/probmap_{step}_merged.jpg", im, ready)
+                self._io_pool.submit(self.save_colormap, f"camera_observations/softmax_probmap_{step}_merged.jpg", im_softmax, ready)
 
         return action